@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import difflib
+import hashlib
 import os
 import json
+import pickle
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+
+# Version of the cached reference strings, increase it when changing how
+# strings are extracted to invalidate existing caches
+CACHE_VERSION = 1
 
 # Import libraries
 try:
@@ -17,10 +26,45 @@ except ImportError as e:
     sys.exit(1)
 
 
+def parse_file(file_path, file_name):
+    """Extract strings from a single file"""
+
+    strings = {}
+    file_extension = os.path.splitext(file_path)[1]
+    file_parser = parser.getParser(file_extension)
+    file_parser.readFile(file_path)
+    try:
+        entities = file_parser.parse()
+        for entity in entities:
+            # Ignore Junk
+            if isinstance(entity, parser.Junk):
+                continue
+
+            string_id = f"{file_name}:{entity}"
+            if file_extension == ".ftl":
+                if entity.raw_val != "":
+                    strings[string_id] = entity.raw_val
+                # Store attributes
+                for attribute in entity.attributes:
+                    attr_string_id = f"{file_name}:{entity}.{attribute}"
+                    strings[attr_string_id] = attribute.raw_val
+            else:
+                strings[string_id] = entity.raw_val
+    except Exception as e:
+        return strings, e
+
+    return strings, None
+
+
 class CheckStrings:
-    def __init__(self, reference_path):
+    def __init__(self, reference_path, root_path):
         """Initialize object"""
 
+        self.root_path = root_path
+
+        # Folder used to store the cached reference strings
+        self.cache_folder = os.path.join(root_path, "cache")
+
         # Set defaults
         self.supported_formats = [
             ".dtd",
@@ -30,9 +74,73 @@ class CheckStrings:
             ".properties",
         ]
 
+        # Spelling rules and compiled patterns, stored by locale
+        self.spelling_rules = {}
+        self.spelling_patterns = {}
+
+        # Cleaned up reference strings and their lowercase version, stored
+        # by ID and shared across locales
+        self.reference_norm = {}
+        self.reference_lower = {}
+
+        # Regular expressions to filter out some syntax
+        self.number_pattern = re.compile(r"NUMBER\(([^\)]+)\)")
+
         # Extract reference strings
-        self.reference_strings = {}
-        self.extractStrings(reference_path, self.reference_strings)
+        self.reference_strings = self.loadReferenceStrings(reference_path)
+
+    def loadReferenceStrings(self, reference_path):
+        """Extract reference strings, using a cached copy if none of the
+        reference files changed since the last run"""
+
+        file_list = self.extractFileList(reference_path)
+        cache_path = self.getCachePath(file_list)
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "rb") as f:
+                    return {sys.intern(id): text for id, text in pickle.load(f).items()}
+            except Exception as e:
+                print(f"Error reading cache file: {cache_path}")
+                print(e)
+
+        reference_strings = {}
+        self.extractStrings(reference_path, reference_strings, file_list)
+
+        # Remove outdated cache files before storing the new one
+        os.makedirs(self.cache_folder, exist_ok=True)
+        for f in os.listdir(self.cache_folder):
+            if f.startswith("reference_") and f.endswith(".pickle"):
+                os.remove(os.path.join(self.cache_folder, f))
+        with open(cache_path, "wb") as f:
+            pickle.dump(reference_strings, f, protocol=5)
+
+        return reference_strings
+
+    def normalizeString(self, text):
+        """Clean up spaces and remove NUMBER() function from a string"""
+
+        # Clean up spaces (trailing, leading, multiple)
+        text = " ".join(text.strip().split()).replace("\n", " ")
+        # Remove NUMBER() function
+        text = self.number_pattern.sub(r"\1", text)
+
+        return text
+
+    def getCachePath(self, file_list):
+        """Get the path of the cache file for a (sorted) list of files"""
+
+        cache_key = hashlib.sha256(f"{CACHE_VERSION}\n".encode("utf-8"))
+        for file_path in file_list:
+            file_stat = os.stat(file_path)
+            cache_key.update(
+                f"{file_path}:{file_stat.st_mtime_ns}:{file_stat.st_size}\n".encode(
+                    "utf-8"
+                )
+            )
+
+        return os.path.join(
+            self.cache_folder, f"reference_{cache_key.hexdigest()}.pickle"
+        )
 
     def extractFileList(self, repository_path):
         """Extract the list of supported files"""
@@ -40,58 +148,62 @@ class CheckStrings:
         excluded_folders = [
             "dom",
         ]
+        supported_formats = tuple(self.supported_formats)
 
-        file_list = []
-        for root, dirs, files in os.walk(repository_path, followlinks=True):
-            # Ignore excluded folders
-            if root == repository_path:
-                dirs[:] = [d for d in dirs if d not in excluded_folders]
-
-            for f in files:
-                for supported_format in self.supported_formats:
-                    if f.endswith(supported_format):
-                        file_list.append(os.path.join(root, f))
+        def scanFolder(path, top_level):
+            # Ignore folders that can't be read, like os.walk does
+            try:
+                entries = os.scandir(path)
+            except OSError:
+                return
+            with entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # Ignore excluded folders
+                        if top_level and entry.name in excluded_folders:
+                            continue
+                        yield from scanFolder(entry.path, False)
+                    elif entry.is_file() and entry.name.endswith(supported_formats):
+                        yield entry.path
+
+        file_list = list(scanFolder(repository_path, True))
         file_list.sort()
 
         return file_list
 
-    def extractStrings(self, repository_path, strings):
+    def extractStrings(self, repository_path, strings, file_list=None):
         """Extract strings in files"""
 
         # Create a list of files to analyze
-        file_list = self.extractFileList(repository_path)
+        if file_list is None:
+            file_list = self.extractFileList(repository_path)
 
+        parse_list = []
         for file_path in file_list:
-            file_extension = os.path.splitext(file_path)[1]
             file_name = self.getRelativePath(file_path, repository_path)
-
             if file_name.endswith("region.properties"):
                 continue
-
-            file_parser = parser.getParser(file_extension)
-            file_parser.readFile(file_path)
-            try:
-                entities = file_parser.parse()
-                for entity in entities:
-                    # Ignore Junk
-                    if isinstance(entity, parser.Junk):
-                        continue
-
-                    string_id = "{}:{}".format(file_name, entity)
-                    if file_extension == ".ftl":
-                        if entity.raw_val != "":
-                            strings[string_id] = entity.raw_val
-                        # Store attributes
-                        for attribute in entity.attributes:
-                            attr_string_id = "{0}:{1}.{2}".format(
-                                file_name, entity, attribute
-                            )
-                            strings[attr_string_id] = attribute.raw_val
-                    else:
-                        strings[string_id] = entity.raw_val
-            except Exception as e:
-                print("Error parsing file: {}".format(file_path))
-                print(e)
+            parse_list.append((file_path, file_name))
+
+        # Parsing is CPU-bound, so spread files across processes
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count()
+        ) as executor:
+            results = executor.map(
+                parse_file,
+                [file_path for file_path, _ in parse_list],
+                [file_name for _, file_name in parse_list],
+                chunksize=16,
+            )
+            for (file_path, _), (file_strings, error) in zip(parse_list, results):
+                # Intern IDs in this process (strings returned by workers are
+                # new objects), so that lookups between reference and locale
+                # strings can compare IDs by identity
+                for string_id, text in file_strings.items():
+                    strings[sys.intern(string_id)] = text
+                if error is not None:
+                    print(f"Error parsing file: {file_path}")
+                    print(error)
 
     def getRelativePath(self, file_name, repository_path):
         """Get the relative path of a filename"""
@@ -100,7 +212,69 @@ class CheckStrings:
 
         return relative_path
 
-    def compareLocale(self, locale, repository_path, write, update, root_path):
+    def classifyString(self, id, translation, locale):
+        """Compare a translation to its reference string. Return None if they
+        match, otherwise the type of difference ("case" or "spelling")"""
+
+        source = self.reference_strings[id]
+
+        # For accesskey and shortcuts, transform both source and
+        # translation to lowercase to avoid false positives
+        is_shortcut = id.endswith((".key", ".accesskey"))
+        if is_shortcut:
+            source = source.lower()
+            translation = translation.lower()
+
+        if translation == source:
+            return None
+
+        # Try cleaning up spaces and removing NUMBER() function. For
+        # accesskeys and shortcuts, the source was already lowercased.
+        translation = self.normalizeString(translation)
+        if is_shortcut:
+            source = self.normalizeString(source)
+        else:
+            if id not in self.reference_norm:
+                self.reference_norm[id] = self.normalizeString(source)
+            source = self.reference_norm[id]
+        # Try converting unicode endpoints to unicode characters
+        if r"\u" in translation:
+            translation = translation.encode("utf8").decode("unicode-escape")
+
+        if translation == source:
+            return None
+
+        if id not in self.reference_lower:
+            self.reference_lower[id] = source.lower()
+        if translation.lower() == self.reference_lower[id]:
+            return "case"
+
+        # Clean up translation differences due to spelling
+        spelling = self.spelling_rules[locale]
+        spelling_patterns = self.spelling_patterns[locale]
+
+        # Initially, the only variation is the source string
+        variations = {source}
+        for word, replacement in spelling.items():
+            # A rule can only change variations that contain its word
+            if not any(word in v for v in variations):
+                continue
+            word_pattern = spelling_patterns[word]
+            if not isinstance(replacement, list):
+                for v in list(variations):
+                    variations.add(word_pattern.sub(replacement, v))
+            else:
+                for r in replacement:
+                    for v in list(variations):
+                        variations.add(word_pattern.sub(r, v))
+
+            # Stop as soon as the translation is a known variation
+            if translation in variations:
+                return None
+
+        return "spelling"
+
+    def compareLocale(self, locale, repository_path, write, update):
         """Extract strings for locale, compare to reference strings"""
 
         # Update repo
@@ -111,12 +285,15 @@ class CheckStrings:
         self.extractStrings(os.path.join(repository_path, locale), locale_strings)
 
         # Load exclusions
-        exclusions_file = os.path.join(root_path, "exclusions", f"{locale}.json")
+        exclusions_file = os.path.join(self.root_path, "exclusions", f"{locale}.json")
         with open(exclusions_file) as f:
-            ignored_strings = json.load(f)
+            # Store exclusions as sets, since they're only used for lookups
+            ignored_strings = {
+                category: set(ids) for category, ids in json.load(f).items()
+            }
 
         # Load spelling changes
-        with open(os.path.join(root_path, "spelling", f"{locale}.json")) as f:
+        with open(os.path.join(self.root_path, "spelling", f"{locale}.json")) as f:
             json_data = json.load(f)
             spelling = json_data["spelling"]
 
@@ -131,76 +308,27 @@ class CheckStrings:
             "spelling": [],
         }
 
-        # Regular expressions to filter out some syntax
-        number_pattern = re.compile(r"NUMBER\(([^\)]+)\)")
+        # Compile spelling patterns once per locale
+        if locale not in self.spelling_patterns:
+            # Negative lookbehind is used to avoid replacing term and variable names
+            self.spelling_patterns[locale] = {
+                word: re.compile(r"\b(?<![$-])" + re.escape(word) + r"\b")
+                for word in spelling
+            }
+            self.spelling_rules[locale] = spelling
 
         for id, translation in locale_strings.items():
             # Ignore obsolete strings
             if id not in self.reference_strings:
                 continue
 
-            source = self.reference_strings[id]
-
-            # For accesskey and shortcuts, transform both source and
-            # translation to lowercase to avoid false positives
-            if id.endswith((".key", ".accesskey")):
-                source = source.lower()
-                translation = translation.lower()
-
-            # Check differences
-            if translation != source:
-                # Try cleaning up spaces (trailing, leading, multiple)
-                translation = " ".join(translation.strip().split()).replace("\n", " ")
-                source = " ".join(source.strip().split()).replace("\n", " ")
-                # Remove NUMBER() function from both source and translation
-                source = re.sub(number_pattern, r"\1", source)
-                translation = re.sub(number_pattern, r"\1", translation)
-                # Try converting unicode endpoints to unicode characters
-                if r"\u" in translation:
-                    translation = translation.encode("utf8").decode("unicode-escape")
-
-                if translation == source:
-                    continue
-                if translation.lower() == source.lower():
-                    if id in ignored_strings["case"]:
-                        used_exceptions["case"].append(id)
-                    else:
-                        differences["case"].append(id)
-                else:
-                    # Clean up translation differences due to spelling
-
-                    # Initially, the only variation is the source string
-                    variations = [source]
-
-                    for word, replacement in spelling.items():
-                        if not isinstance(replacement, list):
-                            for v in variations[:]:
-                                # Negative lookbehind is used to avoid replacing term and variable names
-                                tmp_v = re.sub(
-                                    r"\b(?<![$-]){}\b".format(word), replacement, v
-                                )
-                                if tmp_v not in variations:
-                                    variations.append(tmp_v)
-                        else:
-                            for r in replacement:
-                                for v in variations[:]:
-                                    tmp_v = re.sub(
-                                        r"\b(?<![$-]){}\b".format(word), r, v
-                                    )
-                                    if tmp_v not in variations:
-                                        variations.append(tmp_v)
-
-                    spelling_ok = False
-                    for v in variations:
-                        if translation == v:
-                            spelling_ok = True
-                            break
-
-                    if not spelling_ok:
-                        if id in ignored_strings["spelling"]:
-                            used_exceptions["spelling"].append(id)
-                        else:
-                            differences["spelling"].append(id)
+            category = self.classifyString(id, translation, locale)
+            if category is None:
+                continue
+            if id in ignored_strings[category]:
+                used_exceptions[category].append(id)
+            else:
+                differences[category].append(id)
 
         if differences["case"]:
             print("\nDifferent case:")
@@ -211,68 +339,88 @@ class CheckStrings:
 
         if write:
             # Organize them by file, to avoid opening the same file multiple times
+            # Split each ID into file name and string ID only once
+            parsed_ids = {id: id.split(":", 1) for id in differences["case"]}
             fixes = {}
-            for id in differences["case"]:
-                filename = id.split(":")[0]
+            for id, (filename, _) in parsed_ids.items():
                 if filename not in fixes:
                     fixes[filename] = [id]
                 else:
                     fixes[filename].append(id)
 
+            # Patterns are applied to the whole file, so whitespace around
+            # IDs and values must not span multiple lines
+            ws = r"[^\S\n]*"
             for filename, ids in fixes.items():
+                # Compile one multiline pattern for each string to fix
+                compiled = {}
+                for id in ids:
+                    string_id = parsed_ids[id][1]
+                    translation = re.escape(locale_strings[id])
+                    escaped_id = re.escape(string_id)
+                    # Backslashes in replacements would be interpreted as
+                    # template escapes (e.g. \n), they need to be doubled
+                    reference = self.reference_strings[id].replace("\\", r"\\")
+                    replacement_id = string_id.replace("\\", r"\\")
+                    if ".properties" in id:
+                        # id = text
+                        pattern = rf"^{escaped_id}({ws})=({ws}){translation}({ws})$"
+                        replacement = rf"{replacement_id}\g<1>=\g<2>{reference}\g<3>"
+                    elif ".dtd" in id:
+                        # <!ENTITY id "text"> or <!ENTITY id 'text'>
+                        pattern = rf'{escaped_id}(\s*)("|\'){translation}("|\')'
+                        replacement = rf"{replacement_id}\g<1>\g<2>{reference}\g<3>"
+                    elif ".ftl" in id:
+                        if "." in string_id:
+                            # Attribute
+                            attribute = string_id.split(".")[1]
+                            escaped_attribute = re.escape(attribute)
+                            replacement_attribute = attribute.replace("\\", r"\\")
+                            pattern = (
+                                rf"^({ws})\.{escaped_attribute}({ws})=({ws})"
+                                rf"{translation}({ws})$"
+                            )
+                            replacement = (
+                                rf"\g<1>.{replacement_attribute}\g<2>=\g<3>"
+                                rf"{reference}\g<4>"
+                            )
+                        else:
+                            # Value
+                            pattern = rf"^{escaped_id}({ws})=({ws}){translation}({ws})$"
+                            replacement = (
+                                rf"{replacement_id}\g<1>=\g<2>{reference}\g<3>"
+                            )
+                    else:
+                        continue
+                    compiled[id] = (re.compile(pattern, re.MULTILINE), replacement)
+
                 filename = os.path.join(repository_path, locale, filename)
+
                 with open(filename, "r") as f:
-                    original_content = f.readlines()
-
-                updated_content = []
-                for index, line in enumerate(original_content):
-                    for id in ids:
-                        if locale_strings[id] in line:
-                            string_id = id.split(":")[1]
-                            if ".properties" in id:
-                                # id = text
-                                pattern = r"^{}(\s*)=(\s*){}(\s*$)".format(
-                                    string_id, locale_strings[id]
-                                )
-                                replacement = r"{}\g<1>=\g<2>{}\g<3>".format(
-                                    string_id, self.reference_strings[id]
-                                )
-                                line = re.sub(pattern, replacement, line)
-                            elif ".dtd" in id:
-                                # <!ENTITY id "text"> or <!ENTITY id 'text'>
-                                pattern = r'{}(\s*)("|\'){}("|\')'.format(
-                                    string_id, locale_strings[id]
-                                )
-                                replacement = r"{}\g<1>\g<2>{}\g<3>".format(
-                                    string_id, self.reference_strings[id]
-                                )
-                                line = re.sub(pattern, replacement, line)
-                                # line = line.replace(locale_strings[id], self.reference_strings[id])
-                            elif ".ftl" in id:
-                                if "." in string_id:
-                                    # Attribute
-                                    attribute = string_id.split(".")[1]
-                                    pattern = r"^(\s*)\.{}(\s*)=(\s*){}(\s*$)".format(
-                                        attribute, locale_strings[id]
-                                    )
-                                    replacement = r"\g<1>.{}\g<2>=\g<3>{}\g<4>".format(
-                                        attribute, self.reference_strings[id]
-                                    )
-                                    line = re.sub(pattern, replacement, line)
-                                else:
-                                    # Value
-                                    pattern = r"^{}(\s*)=(\s*){}(\s*$)".format(
-                                        string_id, locale_strings[id]
-                                    )
-                                    replacement = r"{}\g<1>=\g<2>{}\g<3>".format(
-                                        string_id, self.reference_strings[id]
-                                    )
-                                    line = re.sub(pattern, replacement, line)
-
-                    updated_content.append(line)
-
-                with open(filename, "w") as f:
-                    f.writelines(updated_content)
+                    original_content = f.read()
+
+                updated_content = original_content
+                for id, (pattern, replacement) in compiled.items():
+                    if locale_strings[id] in updated_content:
+                        updated_content = pattern.sub(replacement, updated_content)
+
+                if updated_content == original_content:
+                    continue
+
+                # Write to a temporary file in the same folder, then replace
+                # the original file. Don't leave the temporary file behind
+                # in the repository if anything fails.
+                tmp = tempfile.NamedTemporaryFile(
+                    "w", dir=os.path.dirname(filename), delete=False
+                )
+                try:
+                    with tmp:
+                        tmp.write(updated_content)
+                    shutil.copymode(filename, tmp.name)
+                    os.replace(tmp.name, filename)
+                except Exception:
+                    os.unlink(tmp.name)
+                    raise
 
         if differences["spelling"]:
             print("\nDifferent translations:")
@@ -281,17 +429,24 @@ class CheckStrings:
                 print(f"Original:    {self.reference_strings[id]}")
                 print(f"Translation: {locale_strings[id]}")
 
-                output_list = [
-                    li
-                    for li in difflib.ndiff(
-                        self.reference_strings[id], locale_strings[id]
+                a = self.reference_strings[id]
+                b = locale_strings[id]
+                if max(len(a), len(b)) > 200:
+                    # Character diff is too expensive for long strings,
+                    # compare words instead
+                    diff_lines = list(
+                        difflib.unified_diff(a.split(), b.split(), n=1, lineterm="")
                     )
-                    if li[0] != " "
-                ]
+                    # Skip the two header lines (--- and +++)
+                    output_list = [
+                        f"{li[0]} {li[1:]}" for li in diff_lines[2:] if li[0] in "+-"
+                    ]
+                else:
+                    output_list = [li for li in difflib.ndiff(a, b) if li[0] != " "]
                 print("Differences:")
                 print(" ".join(output_list))
 
-        with open(os.path.join(root_path, "output", f"{locale}.json"), "w") as f:
+        with open(os.path.join(self.root_path, "output", f"{locale}.json"), "w") as f:
             json.dump(differences, f, indent=2, sort_keys=True)
 
         # Write back updated exceptions
@@ -317,16 +472,21 @@ def main():
         action="store_true",
         default=False,
     )
-    p.add_argument("locale", help="Locale to check")
+    p.add_argument("locales", nargs="+", help="Locales to check")
     args = p.parse_args()
 
     repo_path = "/Users/flodolo/mozilla/mercurial/firefox-l10n"
     if not os.path.isdir(repo_path):
         sys.exit(f"Path to repository {repo_path} does not exist.")
 
-    check = CheckStrings("/Users/flodolo/mozilla/mercurial/firefox-quarantine")
-    print(f"Checking {args.locale}\n-------\n")
-    check.compareLocale(args.locale, repo_path, args.write, args.update, root_path)
+    check = CheckStrings(
+        "/Users/flodolo/mozilla/mercurial/firefox-quarantine", root_path
+    )
+    for index, locale in enumerate(args.locales):
+        print(f"Checking {locale}\n-------\n")
+        # Only pull from remote once, the repository is shared by all locales
+        update = args.update and index == 0
+        check.compareLocale(locale, repo_path, args.write, update)
 
 
 if __name__ == "__main__":